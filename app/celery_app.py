@@ -6,6 +6,19 @@ from dotenv import load_dotenv
 load_dotenv()
 
 redis_url = os.getenv('REDIS_URL')
+# Number of tasks a worker runs at once; ffmpeg thread counts are derived from it.
+# Defaults to one task per 4 cores: several narrow encodes scale better than one wide one
+CELERY_CONCURRENCY = max(1, int(os.getenv('CELERY_CONCURRENCY', (os.cpu_count() or 1) // 4)))
+
+# visibility_timeout: Redis redelivers unacked tasks after this long, so it must outlast
+# task_time_limit or a long encode is handed to a second worker while still running
+broker_transport_options = {'confirm_publish': False, 'visibility_timeout': 4200}
+# TCP keepalive only applies to TCP brokers, not redis+socket:// unix sockets
+if not (redis_url or '').startswith(('redis+socket://', 'unix://')):
+    broker_transport_options.update({'socket_keepalive': True, 'socket_keepalive_options': {}})
+
+# Trims that must re-encode leave the eventlet trim lane for prefork encode workers
+REENCODE_QUEUE = 'encode_heavy'
 
 celery_app = Celery(
     'video_tasks',
@@ -23,5 +36,28 @@ celery_app.conf.update(
     enable_utc=True,
     task_track_started=True,
     task_time_limit=3600,
-    task_soft_time_limit=3300
+    task_soft_time_limit=3300,
+    # Ack after the task finishes so a crashed worker's job is redelivered, not lost or duplicated
+    task_acks_late=True,
+    task_reject_on_worker_lost=True,
+    # ffmpeg tasks run for minutes: reserve one at a time so idle workers can take the rest
+    worker_prefetch_multiplier=1,
+    # Recycle pool processes periodically to return memory grown across encodes
+    worker_max_tasks_per_child=50,
+    worker_concurrency=CELERY_CONCURRENCY,
+    # Don't wait for the broker to confirm each publish on the request path
+    broker_transport_options=broker_transport_options,
+    # Enough pooled broker connections that fan-out publishes don't queue on one
+    broker_pool_limit=50,
+    # One queue per task class, each with its own workers, so a backlog of heavy
+    # encodes can't hold up trims (mostly stream copies) or overlays.
+    # No worker consumes the stock 'celery' queue, so anything unrouted joins the slow lane
+    task_default_queue='encode_heavy',
+    task_routes={
+        'app.tasks.trim_video_task': {'queue': 'trim_fast'},
+        'app.tasks.add_*_overlay_task': {'queue': 'overlay'},
+        # Full transcodes go to GPU workers; tasks fall back to libx264 on hosts without NVENC
+        'app.tasks.convert_quality_task': {'queue': 'encode_heavy'},
+        'app.tasks.composite_task': {'queue': 'encode_heavy'},
+    }
 )
\ No newline at end of file
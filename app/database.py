@@ -1,22 +1,67 @@
 from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool, QueuePool
 import os
+import uuid
 from dotenv import load_dotenv
 
 load_dotenv()
 
 DATABASE_URL = os.getenv("DATABASE_URL")
+# Set when DATABASE_URL points at PgBouncer (transaction pooling): connections are
+# pooled there, so the app must not pool them again or keep prepared statements
+USE_PGBOUNCER = os.getenv("USE_PGBOUNCER", "false").lower() == "true"
 
-engine = create_engine(DATABASE_URL)
+# The API talks to Postgres through asyncpg so queries don't block the event loop;
+# Celery workers use sync_engine below with the sync driver
+ASYNC_DATABASE_URL = DATABASE_URL.replace("postgresql://", "postgresql+asyncpg://", 1)
 
-SessionLocal = sessionmaker(autocommit = False, autoflush=False, bind=engine)
+if USE_PGBOUNCER:
+    engine = create_async_engine(
+        ASYNC_DATABASE_URL,
+        poolclass=NullPool,
+        connect_args={
+            "statement_cache_size": 0,
+            "prepared_statement_cache_size": 0,
+            # Transaction pooling can hand us a server connection that already
+            # holds a statement with asyncpg's default name
+            "prepared_statement_name_func": lambda: f"__asyncpg_{uuid.uuid4()}__",
+        },
+    )
+else:
+    engine = create_async_engine(
+        ASYNC_DATABASE_URL,
+        pool_size=20,
+        max_overflow=10,
+        pool_recycle=3600,
+        pool_pre_ping=True,
+    )
+
+# Celery workers keep their connections between tasks instead of reconnecting
+# for each one. psycopg2 doesn't use server-side prepared statements, so this
+# is also safe behind PgBouncer's transaction pooling. 10 + 22 covers the 32
+# green threads of the eventlet trim worker
+sync_engine = create_engine(
+    DATABASE_URL,
+    poolclass=QueuePool,
+    pool_size=10,
+    max_overflow=22,
+    pool_pre_ping=True,
+    pool_recycle=1200,
+)
+
+# expire_on_commit=False: attributes stay loaded after commit, since async
+# sessions can't lazy-load them again implicitly
+SessionLocal = async_sessionmaker(bind=engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
+# Shared by every Celery task in a worker process. Objects stay loaded after commit,
+# so caching a finished job's status doesn't cost a refresh SELECT
+SyncSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=sync_engine, expire_on_commit=False)
 
 Base = declarative_base()
 
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with SessionLocal() as db:
         yield db
-    finally:    
-        db.close()
\ No newline at end of file
@@ -0,0 +1,30 @@
+# One-shot schema setup, run as `python -m app.init_db` before the API and workers start
+import logging
+import time
+
+from sqlalchemy.exc import OperationalError
+
+from . import models
+from .database import sync_engine
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def init_db(max_retries: int = 10):
+    retry_delay = 0.5
+    for attempt in range(max_retries):
+        try:
+            logger.info(f"Attempt {attempt + 1}: Creating tables if not exist...")
+            models.Base.metadata.create_all(bind=sync_engine)
+            logger.info("Tables created!")
+            return
+        except OperationalError as e:
+            logger.warning(f"Database not ready: {e}")
+            time.sleep(retry_delay)
+            retry_delay = min(retry_delay * 2, 8)
+    raise SystemExit("Failed to connect to database after all retries")
+
+
+if __name__ == "__main__":
+    init_db()
@@ -0,0 +1,71 @@
+# Redis copy of finished jobs' /status payloads, so polling clients don't hit Postgres
+import json
+import logging
+import os
+
+import redis
+import redis.asyncio as aioredis
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+JOB_CACHE_TTL = 3600  # seconds
+TERMINAL_STATUSES = ("completed", "failed")
+
+# Celery's redis+socket:// is spelled unix:// in redis-py
+_redis_url = (os.getenv('REDIS_URL') or 'redis://localhost:6379/0').replace('redis+socket://', 'unix://', 1)
+
+# Tasks write with the sync client, the API reads with the async one
+_sync_client = redis.Redis.from_url(_redis_url)
+_async_client = aioredis.Redis.from_url(_redis_url)
+
+
+def _key(job_id: str) -> str:
+    return f"job:{job_id}"
+
+
+def job_status_payload(job) -> dict:
+    payload = {
+        "job_id": job.id,
+        "status": job.status,
+        "original_video_id": job.original_video_id,
+        "type": job.type
+    }
+    if job.status == "completed":
+        payload["updated_video_id"] = job.updated_video_id
+        payload["result_filename"] = job.result_filename
+    return payload
+
+
+def cache_job_status(job):
+    """Called by tasks after committing a terminal state; the DB stays the source of truth"""
+    try:
+        _sync_client.setex(_key(job.id), JOB_CACHE_TTL, json.dumps(job_status_payload(job)))
+    except redis.RedisError as e:
+        logger.warning(f"Could not cache status of job {job.id}: {e}")
+
+
+async def get_cached_status(job_id: str):
+    try:
+        cached = await _async_client.get(_key(job_id))
+    except redis.RedisError as e:
+        logger.warning(f"Job cache unavailable: {e}")
+        return None
+    return json.loads(cached) if cached else None
+
+
+async def set_cached_status(payload: dict):
+    try:
+        await _async_client.setex(_key(payload["job_id"]), JOB_CACHE_TTL, json.dumps(payload))
+    except redis.RedisError as e:
+        logger.warning(f"Could not cache status of job {payload['job_id']}: {e}")
+
+
+async def invalidate_status(job_id: str):
+    """For the one way a terminal job changes again: retrying a failed trim"""
+    try:
+        await _async_client.delete(_key(job_id))
+    except redis.RedisError as e:
+        logger.warning(f"Could not invalidate status of job {job_id}: {e}")
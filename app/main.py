@@ -1,122 +1,289 @@
-from fastapi import FastAPI, Depends, HTTPException, UploadFile, File
-from sqlalchemy.orm import Session
-from sqlalchemy import text
-from sqlalchemy.exc import OperationalError
+from fastapi import FastAPI, Depends, HTTPException, UploadFile, File, BackgroundTasks, Request, Response
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import text, select, insert, update, literal
+from sqlalchemy.exc import DBAPIError, IntegrityError
 from fastapi.responses import FileResponse
-import time
+from fastapi.concurrency import run_in_threadpool
+import asyncio
+from contextlib import asynccontextmanager
 import logging
+import mimetypes
 import os
 import uuid
-import ffmpeg
+import base64
+import errno
+import hashlib
+import json
+import shutil
 import subprocess
+import aiofiles
 from fastapi import Form
 
-from .database import Base, engine, get_db
-from . import models
-from pydantic import BaseModel
-from typing import List
-
-class QualityRequest(BaseModel):
-    qualities: List[str] = ["720p", "480p"]
-
-from .celery_app import celery_app
-from .tasks import trim_video_task
+from .database import engine, get_db, SessionLocal
+from . import models, job_cache
+from .probe import probe_video, probe_keyframes
+from .schemas import (
+    TrimRequest, TextOverlayRequest, ImageOverlayRequest, VideoOverlayRequest,
+    QualityRequest, JobCreatedResponse,
+)
+from .celery_app import celery_app, REENCODE_QUEUE
+from .tasks import (
+    trim_video_task, add_text_overlay_task, add_image_overlay_task, add_video_overlay_task,
+    convert_quality_task, composite_task, QUALITY_PRESETS
+)
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 UPLOAD_DIR = "./uploads"
-os.makedirs(UPLOAD_DIR, exist_ok=True)
-
-app = FastAPI(title="Video Editor Backend")
-
-# Health check endpoint — NO DB connection on startup
-@app.get("/health")
-def health_check():
-    return {"status": "OK", "message": "Backend is running"}
-
-# Only create tables after app is running
-@app.on_event("startup")
-async def startup_event():
-    logger.info("⏳ Starting up... Waiting 10 seconds for DB to be fully ready...")
-    time.sleep(10)  # Give PostgreSQL time to fully initialize
-    
-    max_retries = 5
-    retry_delay = 5
+UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024  # 4MB chunks amortize syscalls on large videos
+# Behind nginx, /download hands the file body back to it via X-Accel-Redirect;
+# X_ACCEL_PREFIX must be an `internal` location aliased to the uploads directory
+USE_X_ACCEL = os.getenv("USE_X_ACCEL", "false").lower() == "true"
+X_ACCEL_PREFIX = os.getenv("X_ACCEL_PREFIX", "/internal-uploads/")
+
+def short_uid():
+    # 22 url-safe chars instead of the 32/36 of hex/str(uuid4())
+    return base64.urlsafe_b64encode(uuid.uuid4().bytes).rstrip(b'=').decode()
+
+async def _wait_for_database():
+    # Tables are created by the one-shot init container (python -m app.init_db);
+    # here we only check connectivity, backing off from 0.5s up to 8s
+    max_retries = 10
+    retry_delay = 0.5
     
     for attempt in range(max_retries):
         try:
             logger.info(f"Attempt {attempt + 1}: Connecting to database...")
-            with engine.connect() as conn:
-                logger.info("Database connected!")
+            async with engine.connect() as conn:
+                await conn.execute(text("SELECT 1"))
+            logger.info("Database connected!")
+            return
                 
-                # Create tables
-                logger.info("Creating tables if not exist...")
-                models.Base.metadata.create_all(bind=engine)
-                logger.info("Tables created!")
-                return
-                
-        except OperationalError as e:
+        # asyncpg surfaces refused connections as plain OSError
+        except (DBAPIError, OSError) as e:
             logger.warning(f"Database not ready: {e}")
             if attempt < max_retries - 1:
-                time.sleep(retry_delay)
+                await asyncio.sleep(retry_delay)
+                retry_delay = min(retry_delay * 2, 8)
             else:
                 logger.error("Failed to connect to database after all retries")
+
+# Startup side effects live here rather than at import time
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    # Probe the DB in the background so /health answers while Postgres warms up
+    db_check = asyncio.create_task(_wait_for_database())
+    yield
+    db_check.cancel()
+
+app = FastAPI(title="Video Editor Backend", lifespan=lifespan)
+
+# Health check endpoint — NO DB connection on startup
+@app.get("/health")
+def health_check():
+    return {"status": "OK", "message": "Backend is running"}
              
 @app.get("/")
 def read_root():
     return {"message": "Video Editor Backend is running!"}
 
-@app.post("/upload")
-async def upload_video(file: UploadFile = File(...), db: Session = Depends(get_db)):
-    # Generate safe unique filename
-    file_extension = file.filename.split('.')[-1] if '.' in file.filename else 'mp4'
-    safe_filename = f"{uuid.uuid4().hex}.{file_extension}"
-    file_path = os.path.join(UPLOAD_DIR, safe_filename)
-    
-    logger.info(f"File name: {file_path}")  # ← FIXED LOGGING
-    
-   
+async def _save_upload(upload: UploadFile, path: str):
+    # Stream in chunks: never holds the whole file in memory or blocks the loop on writes
+    async with aiofiles.open(path, "wb") as f:
+        while chunk := await upload.read(UPLOAD_CHUNK_SIZE):
+            await f.write(chunk)
+
+async def _commit_upload(db: AsyncSession, file_path: str, video_id: int):
+    # Runs after the response is sent; the session is owned by this task from here on
     try:
-        with open(file_path, "wb") as f:
-            while chunk := await file.read(1024 * 1024):  # 1MB chunks
-                f.write(chunk)
+        await db.commit()
     except Exception as e:
-        if os.path.exists(file_path):
-            os.remove(file_path)
-        raise HTTPException(status_code=500, detail=f"Failed to save file: {str(e)}")
-    
-    # Extract metadata using ffmpeg
+        await db.rollback()
+        logger.error(f"Database error: {e}")
+        _discard(file_path)
+        return
+    finally:
+        await db.close()
+    await _record_keyframes(file_path, video_id)
+
+async def _record_keyframes(file_path: str, video_id: int):
+    # Reads the whole file, so it runs after the response; until it lands, trims
+    # of this video fall back to checking the cut after a stream copy
     try:
-        probe = ffmpeg.probe(file_path)
-        format_info = probe.get('format', {})
-        video_stream = next((s for s in probe.get('streams', []) if s.get('codec_type') == 'video'), None)
-        
-        duration = float(format_info.get('duration', 0.0))
-        size = int(format_info.get('size', 0))
-        
+        keyframes = await run_in_threadpool(probe_keyframes, file_path)
+        if keyframes is None:
+            return
+        async with SessionLocal() as db:
+            await db.execute(
+                update(models.Video).where(models.Video.id == video_id).values(keyframes=json.dumps(keyframes))
+            )
+            await db.commit()
     except Exception as e:
-        # Clean up file if metadata fails
-        if os.path.exists(file_path):
-            os.remove(file_path)
-        raise HTTPException(status_code=400, detail=f"Invalid video file: {str(e)}")
-    
-    # Save to database
+        logger.warning(f"Could not record keyframes of video {video_id}: {e}")
+
+def _discard(path: str):
+    # Cleanup on error paths: remove without a separate exists() stat
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def _link_or_copy(src: str, dst: str):
+    # A hardlink shares the source's blocks; only across filesystems do we copy
+    _discard(dst)
     try:
-        db_video = models.Video(
-            filename=safe_filename,
-            duration=duration,
-            size=size
+        os.link(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.copyfile(src, dst)
+
+async def _complete_with_link(db: AsyncSession, job: models.Job, input_path: str, output_path: str, duration: float):
+    """Finish a job whose output equals its input without dispatching it"""
+    await run_in_threadpool(_link_or_copy, input_path, output_path)
+    # The output is byte-identical, so its stream metadata and keyframes are copied from
+    # the source row inside the INSERT, without loading them here
+    stream_columns = ("width", "height", "codec", "frame_rate", "keyframes")
+    new_video_id = (await db.execute(
+        insert(models.Video)
+        .from_select(
+            ["filename", "original_video_id", "duration", "size", *stream_columns],
+            select(
+                literal(os.path.basename(output_path)),
+                models.Video.id,
+                literal(duration, models.Video.duration.type),
+                literal(os.path.getsize(output_path)),
+                *(getattr(models.Video, c) for c in stream_columns)
+            ).where(models.Video.id == job.original_video_id)
         )
-        db.add(db_video)
-        db.commit()
-        db.refresh(db_video)
+        .returning(models.Video.id)
+    )).scalar_one()
+
+    job.status = "completed"
+    job.result_filename = os.path.basename(output_path)
+    job.updated_video_id = new_video_id
+
+async def _get_available_video(db: AsyncSession, video_id: int, detail: str = "Video not found") -> models.Video:
+    """The video row, or 404 unless it is available.
+
+    Endpoints trust the DB's status instead of stat'ing the file; if the file is
+    missing anyway, the job fails instead.
+    """
+    video = await db.get(models.Video, video_id)
+    if not video or video.status != "available":
+        raise HTTPException(status_code=404, detail=detail)
+    return video
+
+async def _noop_overlay(db: AsyncSession, video: models.Video, job_type: str, suffix: str):
+    """Record an overlay that would draw nothing as an already completed job"""
+    name, ext = os.path.splitext(video.filename)
+    job_id = short_uid()
+    output_path = os.path.join(UPLOAD_DIR, f"{name}_{suffix}_{job_id[:8]}{ext}")
+
+    job = models.Job(
+        id=job_id,
+        original_video_id=video.id,
+        status="pending",
+        type=job_type
+    )
+    db.add(job)
+    await _complete_with_link(db, job, os.path.join(UPLOAD_DIR, video.filename), output_path, video.duration)
+    await db.commit()
+
+    return {
+        "job_id": job_id,
+        "status": "completed",
+        "message": "Overlay is never visible, no processing needed",
+        "type": job_type
+    }
+
+async def _iter_upload(upload: UploadFile):
+    while chunk := await upload.read(UPLOAD_CHUNK_SIZE):
+        yield chunk
+
+async def _write_hashed(chunks, file_path: str) -> str:
+    # Hash while writing so duplicate uploads can be detected without rereading the file
+    hasher = hashlib.sha256()
+    buffer = bytearray()
+    try:
+        async with aiofiles.open(file_path, "wb") as f:
+            async for chunk in chunks:
+                hasher.update(chunk)
+                if not buffer and len(chunk) >= UPLOAD_CHUNK_SIZE:
+                    await f.write(chunk)
+                    continue
+                # Coalesce small ASGI body messages into UPLOAD_CHUNK_SIZE writes
+                buffer += chunk
+                if len(buffer) >= UPLOAD_CHUNK_SIZE:
+                    await f.write(buffer)
+                    buffer.clear()
+            if buffer:
+                await f.write(buffer)
     except Exception as e:
-        db.rollback()
-        logger.error(f"Database error: {e}")
-        if os.path.exists(file_path):
+        _discard(file_path)
+        raise HTTPException(status_code=500, detail=f"Failed to save file: {str(e)}")
+    return hasher.hexdigest()
+
+async def _register_upload(background_tasks: BackgroundTasks, file_path: str, safe_filename: str, digest: str):
+    size = os.path.getsize(file_path)
+
+    # Not using Depends(get_db): the session must outlive the request so the
+    # commit can run as a background task after the response is sent
+    db = SessionLocal()
+    committing_in_background = False
+    try:
+        # Same content already stored: drop the new copy and skip probing
+        existing = (await db.execute(
+            select(models.Video).where(models.Video.sha256 == digest)
+        )).scalars().first()
+        if existing:
             os.remove(file_path)
-        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+            return {
+                "id": existing.id,
+                "filename": existing.filename,
+                "duration": existing.duration,
+                "size": existing.size,
+                "upload_time": existing.upload_time
+            }
+        
+        # Extract metadata from the header: duration and stream info, stored so tasks never probe the source
+        try:
+            # Probing is blocking file I/O; keep it off the event loop. The
+            # threadpool's capacity limiter also caps how many probes run at once.
+            meta = await run_in_threadpool(probe_video, file_path)
+        except Exception as e:
+            # Clean up file if metadata fails
+            _discard(file_path)
+            raise HTTPException(status_code=400, detail=f"Invalid video file: {str(e)}")
+        
+        # Save to database: flush assigns the id, the COMMIT happens after the response
+        try:
+            db_video = models.Video(
+                filename=safe_filename,
+                duration=meta["duration"],
+                size=size,
+                sha256=digest,
+                width=meta["width"],
+                height=meta["height"],
+                codec=meta["codec"],
+                frame_rate=meta["frame_rate"]
+            )
+            db.add(db_video)
+            await db.flush()
+            await db.refresh(db_video)
+        except Exception as e:
+            await db.rollback()
+            logger.error(f"Database error: {e}")
+            _discard(file_path)
+            raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+
+        background_tasks.add_task(_commit_upload, db, file_path, db_video.id)
+        committing_in_background = True
+    finally:
+        if not committing_in_background:
+            await db.close()
     
     return {
         "id": db_video.id,
@@ -126,119 +293,218 @@ async def upload_video(file: UploadFile = File(...), db: Session = Depends(get_d
         "upload_time": db_video.upload_time
     }
 
-@app.post("/trim")
-async def trim_video(video_id: int, start_time: float, end_time:float ,db: Session=Depends(get_db)):
-
-    video = db.query(models.Video).filter(models.Video.id == video_id).first()
-    if not video:
-        raise HTTPException(status_code=404, detail="Video not found")
+@app.post("/upload")
+async def upload_video(background_tasks: BackgroundTasks, file: UploadFile = File(...)):
+    # Generate safe unique filename
+    file_extension = file.filename.split('.')[-1] if '.' in file.filename else 'mp4'
+    safe_filename = f"{short_uid()}.{file_extension}"
+    file_path = os.path.join(UPLOAD_DIR, safe_filename)
     
-    input_path = os.path.join(UPLOAD_DIR, video.filename)
-    if not os.path.exists(input_path):
-        raise HTTPException(status_code=404, detail="Source file not found")
+    logger.info(f"File name: {file_path}")  # ← FIXED LOGGING
     
-    name, ext = os.path.splitext(video.filename)
-    job_id = str(uuid.uuid4())
-    output_filename = f"{name}_trimmed_{job_id[:8]}{ext}"
-    output_path = os.path.join(UPLOAD_DIR, output_filename)
+    digest = await _write_hashed(_iter_upload(file), file_path)
+    return await _register_upload(background_tasks, file_path, safe_filename, digest)
+
+# Raw request body instead of multipart: skips the UploadFile temp-file spool, so
+# the video is written to disk once. Fast path for CLI/SDK clients; /upload stays for forms.
+@app.post("/upload/stream")
+async def upload_video_stream(request: Request, background_tasks: BackgroundTasks, filename: str = "video.mp4"):
+    filename = os.path.basename(filename)  # client-supplied; only the extension is used
+    file_extension = filename.split('.')[-1] if '.' in filename else 'mp4'
+    safe_filename = f"{short_uid()}.{file_extension}"
+    file_path = os.path.join(UPLOAD_DIR, safe_filename)
 
-    job = models.Job(
-        id=job_id,
-        original_video_id=video_id,
-        status="pending",
-        type="trim"
-    )
+    logger.info(f"File name: {file_path}")
 
-    db.add(job)
-    db.commit()
+    digest = await _write_hashed(request.stream(), file_path)
+    return await _register_upload(background_tasks, file_path, safe_filename, digest)
+
+@app.post("/trim", response_model=JobCreatedResponse)
+async def trim_video(req: TrimRequest = Depends(), db: AsyncSession = Depends(get_db)):
+
+    # Identical parameters map to the same job id, so client retries collapse onto one job
+    job_id = hashlib.sha256(f"{req.video_id}:{req.start_time}:{req.end_time}:{req.reencode}:trim".encode()).hexdigest()[:32]
+    job = await db.get(models.Job, job_id)
+    if job and job.status != "failed":
+        return {
+            "job_id": job.id,
+            "status": job.status,
+            "message": "Identical trim job already exists",
+            "type": job.type
+        }
+
+    retrying = job is not None
+    try:
+        if retrying:
+            # Retrying a failed trim reuses its row
+            video = await db.get(models.Video, req.video_id)
+            found = (video.filename, video.duration) if video and video.status == "available" else None
+            job.status = "pending"
+        else:
+            # Insert the job only if the video is available and read its filename back
+            # in the same statement, instead of a SELECT followed by an INSERT
+            found = (await db.execute(
+                insert(models.Job)
+                .from_select(
+                    ["id", "original_video_id", "status", "type"],
+                    select(literal(job_id), models.Video.id, literal("pending"), literal("trim"))
+                    .where(models.Video.id == req.video_id, models.Video.status == "available")
+                )
+                .returning(
+                    select(models.Video.filename).where(models.Video.id == req.video_id).scalar_subquery(),
+                    select(models.Video.duration).where(models.Video.id == req.video_id).scalar_subquery()
+                )
+            )).one_or_none()
+
+        if found is None:
+            await db.rollback()
+            raise HTTPException(status_code=404, detail="Video not found")
+        filename, duration = found
+
+        input_path = os.path.join(UPLOAD_DIR, filename)
+
+        name, ext = os.path.splitext(filename)
+        output_filename = f"{name}_trimmed_{job_id[:8]}{ext}"
+        output_path = os.path.join(UPLOAD_DIR, output_filename)
 
-    celery_app.send_task(
-        "app.tasks.trim_video_task",
-        args=[job_id, input_path, output_path, start_time, end_time - start_time],
-        task_id=job_id
+        # The cut spans the whole video: link the source instead of running ffmpeg
+        noop = req.start_time <= 0 and duration and req.end_time >= duration
+        if noop:
+            job = job or await db.get(models.Job, job_id)
+            await _complete_with_link(db, job, input_path, output_path, duration)
+
+        await db.commit()
+    except IntegrityError:
+        # A concurrent identical request inserted the job first
+        await db.rollback()
+        job = await db.get(models.Job, job_id)
+        return {
+            "job_id": job.id,
+            "status": job.status,
+            "message": "Identical trim job already exists",
+            "type": job.type
+        }
+
+    if retrying:
+        # The cached status still says "failed", and the result backend still holds the
+        # failed run's PROCESSING state (the task ignores results), which /status would report
+        await job_cache.invalidate_status(job_id)
+        await run_in_threadpool(lambda: celery_app.AsyncResult(job_id).forget())
+
+    if noop:
+        return {
+            "job_id": job_id,
+            "status": "completed",
+            "message": "Trim covers the whole video, no processing needed",
+            "type": "trim"
+        }
+
+    trim_video_task.apply_async(
+        args=[job_id, input_path, output_path, req.start_time, req.end_time - req.start_time, req.reencode],
+        task_id=job_id,
+        # A requested re-encode skips the trim lane, which is sized for stream copies
+        queue=REENCODE_QUEUE if req.reencode else None,
+        ignore_result=True
     )
 
     return {
         "job_id": job_id,
         "status": "pending",
         "message": "Video trimming started in background",
-        "type": job.type
+        "type": "trim"
     }
 
 @app.get("/status/{job_id}")
-async def get_job_status(job_id: str, db: Session= Depends(get_db)):
-
-    job = db.query(models.Job).filter(models.Job.id == job_id).first()
-    if not job:
-        raise HTTPException(status_code=404, detail="JOB not found")
-    
-
-    response = {
-        "job_id": job.id,
-        "status": job.status,
-        "original_video_id": job.original_video_id,
-        "type": job.type
-    }
-    
-    if job.status == "completed":
-        response["updated_video_id"] = job.updated_video_id
-        response["result_filename"] = job.result_filename
-        
-    return response
+async def get_job_status(job_id: str, request: Request, response: Response, db: AsyncSession = Depends(get_db)):
+
+    # Finished jobs are served from Redis; only in-flight ones reach Postgres
+    payload = await job_cache.get_cached_status(job_id)
+    if payload is None:
+        job = await db.get(models.Job, job_id)
+        if not job:
+            raise HTTPException(status_code=404, detail="JOB not found")
+        payload = job_cache.job_status_payload(job)
+        if job.status in job_cache.TERMINAL_STATUSES:
+            await job_cache.set_cached_status(payload)
+        elif job.status == "pending":
+            # Tasks report that they've started through Celery state only
+            state = await run_in_threadpool(lambda: celery_app.AsyncResult(job_id).state)
+            if state in ("PROCESSING", "STARTED"):
+                payload["status"] = "processing"
+
+    etag = '"' + hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()[:16] + '"'
+    # A completed job never changes again; a failed trim can still be retried
+    if payload["status"] == "completed":
+        cache_control = "public, max-age=3600, immutable"
+    else:
+        cache_control = "no-cache"
+    headers = {"ETag": etag, "Cache-Control": cache_control}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+
+    response.headers.update(headers)
+    return payload
+
+@app.post("/overlay/text", response_model=JobCreatedResponse)
+async def add_text_overlay(req: TextOverlayRequest = Depends(), db: AsyncSession = Depends(get_db)):
+    video = await _get_available_video(db, req.video_id)
+
+    if req.quality is not None and req.quality not in QUALITY_PRESETS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid quality: {req.quality}. Available: {list(QUALITY_PRESETS.keys())}"
+        )
 
-@app.post("/overlay/text")
-async def add_text_overlay(
-    video_id: int,
-    text: str,
-    x: int = 10,
-    y: int = 10,
-    font_size: int = 24,
-    font_color: str = "white",
-    start_time: float = 0.0,
-    end_time: float = 0.0,
-    db: Session = Depends(get_db)
-):
-    video = db.query(models.Video).filter(models.Video.id == video_id).first()
-    if not video:
-        raise HTTPException(status_code=404, detail="Video not found")
+    # end_time 0 means "until the end"; a closed window that's empty draws nothing
+    draws = bool(req.text.strip()) and not (0 < req.end_time <= req.start_time)
+    if not draws and req.quality is None:
+        return await _noop_overlay(db, video, "TextOverlay", "text")
     
     input_path = os.path.join(UPLOAD_DIR, video.filename)
-    if not os.path.exists(input_path):
-        raise HTTPException(status_code=404, detail="Source file not found")
     
     name, ext = os.path.splitext(video.filename)
-    job_id = str(uuid.uuid4())
+    job_id = short_uid()
     output_filename = f"{name}_text_{job_id[:8]}{ext}"
+    if req.quality is not None:
+        output_filename = f"{name}_text_{job_id[:8]}_{req.quality}{ext}"
     output_path = os.path.join(UPLOAD_DIR, output_filename)
 
     overlay = models.Overlay(
-        video_id=video_id,
+        video_id=req.video_id,
         overlay_type="text",
-        content=text,
-        position_x=x,
-        position_y=y,
-        start_time=start_time,
-        end_time=end_time,
-        font_size=font_size,
-        font_color=font_color,
+        content=req.text,
+        position_x=req.x,
+        position_y=req.y,
+        start_time=req.start_time,
+        end_time=req.end_time,
+        font_size=req.font_size,
+        font_color=req.font_color,
     )
     db.add(overlay)
-    db.commit()
+    await db.flush()  # assigns overlay.id without committing
 
     job = models.Job(
         id=job_id,
-        original_video_id=video_id,
+        original_video_id=req.video_id,
         status="pending",
         type="TextOverlay"
     )
     db.add(job)
-    db.commit()
-
-    celery_app.send_task(
-        "app.tasks.add_text_overlay_task",
-        args=[job_id, input_path, output_path, overlay.id],
-        task_id=job_id
-    )
+    await db.commit()
+
+    if req.quality is not None:
+        # Overlay and scale in one encode instead of an overlay job plus a /quality job
+        composite_task.apply_async(
+            args=[job_id, input_path, output_path, overlay.id if draws else None, req.quality],
+            task_id=job_id,
+            ignore_result=True
+        )
+    else:
+        add_text_overlay_task.apply_async(
+            args=[job_id, input_path, output_path, overlay.id],
+            task_id=job_id,
+            ignore_result=True
+        )
 
     return {
         "job_id": job_id,
@@ -247,186 +513,157 @@ async def add_text_overlay(
         "type": job.type
     }
 
-@app.post("/overlay/image")
+@app.post("/overlay/image", response_model=JobCreatedResponse)
 async def add_image_overlay(
-    video_id: int,
+    req: ImageOverlayRequest = Depends(),
     image_file: UploadFile = File(...),
-    x: int = 10,
-    y: int = 10,
-    width: int = 100,
-    height: int = 100,
-    start_time: float = 0.0,
-    end_time: float = 0.0,
-    opacity: float = 1.0,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     # Validate video
-    video = db.query(models.Video).filter(models.Video.id == video_id).first()
-    if not video:
-        raise HTTPException(status_code=404, detail="Video not found")
+    video = await _get_available_video(db, req.video_id)
+
+    # Checked before saving the upload: an invisible overlay never needs the image
+    if req.opacity <= 0 or 0 < req.end_time <= req.start_time:
+        return await _noop_overlay(db, video, "ImageOverlay", "img_overlay")
 
     input_path = os.path.join(UPLOAD_DIR, video.filename)
-    if not os.path.exists(input_path):
-        raise HTTPException(status_code=404, detail="Source file not found")
 
     # Validate and save image
     if not image_file.filename.lower().endswith(('.png', '.jpg', '.jpeg')):
         raise HTTPException(status_code=400, detail="Only PNG/JPG images allowed")
 
     img_extension = image_file.filename.split('.')[-1]
-    img_filename = f"overlay_img_{uuid.uuid4().hex}.{img_extension}"
+    img_filename = f"overlay_img_{short_uid()}.{img_extension}"
     img_path = os.path.join(UPLOAD_DIR, img_filename)
 
-    with open(img_path, "wb") as f:
-        content = await image_file.read()
-        f.write(content)
+    await _save_upload(image_file, img_path)
 
     # Generate output filename
     name, ext = os.path.splitext(video.filename)
-    job_id = str(uuid.uuid4())
+    job_id = short_uid()
     output_filename = f"{name}_img_overlay_{job_id[:8]}{ext}"
     output_path = os.path.join(UPLOAD_DIR, output_filename)
 
     # Save overlay config
     overlay = models.Overlay(
-        video_id=video_id,
+        video_id=req.video_id,
         overlay_type="image",
         content=image_file.filename,
-        position_x=x,
-        position_y=y,
-        start_time=start_time,
-        end_time=end_time,
-        opacity=opacity,
-        scale_width=width,
-        scale_height=height
+        position_x=req.x,
+        position_y=req.y,
+        start_time=req.start_time,
+        end_time=req.end_time,
+        opacity=req.opacity,
+        scale_width=req.width,
+        scale_height=req.height
     )
     db.add(overlay)
-    db.commit()
 
     # Create job
     job = models.Job(
         id=job_id,
-        original_video_id=video_id,
+        original_video_id=req.video_id,
         status="pending",
         type="ImageOverlay"
     )
     db.add(job)
-    db.commit()
+    await db.commit()
 
     # Send to Celery
-    celery_app.send_task(
-        "app.tasks.add_image_overlay_task",
-        args=[job_id, input_path, output_path, img_path, x, y, width, height, start_time, end_time, opacity],
-        task_id=job_id
+    add_image_overlay_task.apply_async(
+        args=[job_id, input_path, output_path, img_path, req.x, req.y, req.width, req.height, req.start_time, req.end_time, req.opacity],
+        task_id=job_id,
+        ignore_result=True
     )
 
     return {
         "job_id": job_id,
         "status": "pending",
         "message": "Image overlay processing started",
+        "type": job.type
     }
 
 
-@app.post("/overlay/video")
+@app.post("/overlay/video", response_model=JobCreatedResponse)
 async def add_video_overlay(
-    video_id: int,
+    req: VideoOverlayRequest = Depends(),
     overlay_video: UploadFile = File(...),
-    x: int = 10,
-    y: int = 10,
-    width: int = 320,
-    height: int = 240,
-    start_time: float = 0.0,
-    end_time: float = 0.0,
-    opacity: float = 1.0,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     # Validate main video
-    video = db.query(models.Video).filter(models.Video.id == video_id).first()
-    if not video:
-        raise HTTPException(status_code=404, detail="Main video not found")
+    video = await _get_available_video(db, req.video_id, detail="Main video not found")
+
+    # Checked before saving the upload: an invisible overlay never needs the overlay video
+    if req.opacity <= 0 or 0 < req.end_time <= req.start_time:
+        return await _noop_overlay(db, video, "VideoOverlay", "vid_overlay")
 
     input_path = os.path.join(UPLOAD_DIR, video.filename)
-    if not os.path.exists(input_path):
-        raise HTTPException(status_code=404, detail="Source file not found")
 
     # Validate and save overlay video
     if not overlay_video.filename.lower().endswith(('.mp4', '.mov', '.avi', '.mkv')):
         raise HTTPException(status_code=400, detail="Only MP4/MOV/AVI/MKV videos allowed")
 
     overlay_extension = overlay_video.filename.split('.')[-1]
-    overlay_filename = f"overlay_vid_{uuid.uuid4().hex}.{overlay_extension}"
+    overlay_filename = f"overlay_vid_{short_uid()}.{overlay_extension}"
     overlay_path = os.path.join(UPLOAD_DIR, overlay_filename)
 
-    with open(overlay_path, "wb") as f:
-        content = await overlay_video.read()
-        f.write(content)
+    await _save_upload(overlay_video, overlay_path)
 
     # Generate output filename
     name, ext = os.path.splitext(video.filename)
-    job_id = str(uuid.uuid4())
+    job_id = short_uid()
     output_filename = f"{name}_vid_overlay_{job_id[:8]}{ext}"
     output_path = os.path.join(UPLOAD_DIR, output_filename)
 
     # Save overlay config
     overlay = models.Overlay(
-        video_id=video_id,
+        video_id=req.video_id,
         overlay_type="video",
         content=overlay_video.filename,
-        position_x=x,
-        position_y=y,
-        start_time=start_time,
-        end_time=end_time,
-        opacity=opacity,
-        scale_width=width,
-        scale_height=height
+        position_x=req.x,
+        position_y=req.y,
+        start_time=req.start_time,
+        end_time=req.end_time,
+        opacity=req.opacity,
+        scale_width=req.width,
+        scale_height=req.height
     )
     db.add(overlay)
-    db.commit()
 
     # Create job
     job = models.Job(
         id=job_id,
-        original_video_id=video_id,
+        original_video_id=req.video_id,
         status="pending",
         type="VideoOverlay"
     )
     db.add(job)
-    db.commit()
+    await db.commit()
 
     # Send to Celery
-    celery_app.send_task(
-        "app.tasks.add_video_overlay_task",
-        args=[job_id, input_path, output_path, overlay_path, x, y, width, height, start_time, end_time, opacity],
-        task_id=job_id
+    add_video_overlay_task.apply_async(
+        args=[job_id, input_path, output_path, overlay_path, req.x, req.y, req.width, req.height, req.start_time, req.end_time, req.opacity],
+        task_id=job_id,
+        ignore_result=True
     )
 
     return {
         "job_id": job_id,
         "status": "pending",
         "message": "Video overlay processing started",
+        "type": job.type
     }
 
-QUALITY_PRESETS = {
-    "1080p": {"width": 1920, "height": 1080, "bitrate": "8000k"},
-    "720p": {"width": 1280, "height": 720, "bitrate": "4000k"},
-    "480p": {"width": 854, "height": 480, "bitrate": "2000k"},
-    "360p": {"width": 640, "height": 360, "bitrate": "1000k"},
-}
-
 @app.post("/quality/{video_id}")
 async def generate_quality_versions(
     video_id: int,
     request: QualityRequest,  # Default to these if not specified
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     # Validate video
-    video = db.query(models.Video).filter(models.Video.id == video_id).first()
-    if not video:
-        raise HTTPException(status_code=404, detail="Video not found")
+    video = await _get_available_video(db, video_id)
 
     input_path = os.path.join(UPLOAD_DIR, video.filename)
-    if not os.path.exists(input_path):
-        raise HTTPException(status_code=404, detail="Source file not found")
     
     qualities = request.qualities
     # Validate requested qualities
@@ -437,63 +674,89 @@ async def generate_quality_versions(
             detail=f"Invalid qualities: {invalid_qualities}. Available: {list(QUALITY_PRESETS.keys())}"
         )
 
-    job_ids = []
-    
-    for quality in qualities:
-        # Skip if already generated
-        existing = db.query(models.VideoQuality)\
-            .filter(models.VideoQuality.video_id == video_id)\
-            .filter(models.VideoQuality.quality == quality).first()
-        
-        if existing:
-            continue
-
-        # Generate output filename
-        name, ext = os.path.splitext(video.filename)
-        output_filename = f"{name}_{quality}{ext}"
-        output_path = os.path.join(UPLOAD_DIR, output_filename)
+    name, ext = os.path.splitext(video.filename)
+    job_id = short_uid()
+    # Skip qualities already generated, found in one round trip
+    existing = set((await db.execute(
+        select(models.VideoQuality.quality)
+        .where(models.VideoQuality.video_id == video_id)
+        .where(models.VideoQuality.quality.in_(qualities))
+    )).scalars())
+
+    # dict.fromkeys drops repeated qualities but keeps the requested order. The job id
+    # in the name keeps overlapping jobs for the same quality from writing one file
+    outputs = {
+        quality: os.path.join(UPLOAD_DIR, f"{name}_{quality}_{job_id[:8]}{ext}")
+        for quality in dict.fromkeys(qualities)
+        if quality not in existing
+    }
 
-        # Create job
-        job_id = str(uuid.uuid4())
-        job = models.Job(
+    # One job and one ffmpeg run for all missing qualities, so the source is decoded once
+    job_ids = []
+    if outputs:
+        db.add(models.Job(
             id=job_id,
             original_video_id=video_id,
             status="pending"
-        )
-        db.add(job)
-        db.commit()
+        ))
+        await db.commit()
 
         # Send to Celery
-        celery_app.send_task(
-            "app.tasks.convert_quality_task",
-            args=[job_id, input_path, output_path, quality],
+        convert_quality_task.apply_async(
+            args=[job_id, input_path, outputs],
             task_id=job_id
         )
-
         job_ids.append(job_id)
 
     return {
         "video_id": video_id,
         "requested_qualities": qualities,
         "job_ids": job_ids,
-        "message": f"Generating {len(job_ids)} quality versions"
+        "message": f"Generating {len(outputs)} quality versions"
     }
 
 @app.get("/download/{filename}")
-def download_file(filename: str):
+async def download_file(filename: str, request: Request, db: AsyncSession = Depends(get_db)):
     # Security check
     if ".." in filename or filename.startswith("/"):
         raise HTTPException(status_code=400, detail="Invalid filename")
 
     # Look for file in uploads directory
     file_path = os.path.join(UPLOAD_DIR, filename)
-    
-    if not os.path.exists(file_path):
+
+    # One stat serves both the 404 check and FileResponse's Content-Length
+    try:
+        stat_result = os.stat(file_path)
+    except FileNotFoundError:
         raise HTTPException(status_code=404, detail="File not found")
 
+    video = (await db.execute(
+        select(models.Video).where(models.Video.filename == filename)
+    )).scalars().first()
+    # Uploads are hashed once fully written and never rewritten, so they can be cached
+    # for good. Task outputs may still be being written, or rewritten by a retried job:
+    # clients revalidate those (FileResponse sends ETag/Last-Modified from the stat)
+    headers = {"Cache-Control": "no-cache"}
+    if video and video.sha256:
+        headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        etag = f'"{video.sha256[:16]}"'
+        headers["ETag"] = etag
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers=headers)
+
+    media_type = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+
+    if USE_X_ACCEL:
+        # nginx sends the body (and handles Range) with sendfile; Python serves no payload
+        headers["X-Accel-Redirect"] = f"{X_ACCEL_PREFIX}{filename}"
+        headers["Content-Disposition"] = f'attachment; filename="{filename}"'
+        return Response(media_type=media_type, headers=headers)
+
+    # Passing stat_result lets Starlette skip its own stat before sendfile
     return FileResponse(
         file_path,
-        media_type="video/mp4",
-        filename=filename
+        media_type=media_type,
+        filename=filename,
+        stat_result=stat_result,
+        headers=headers
     )
-
@@ -1,4 +1,5 @@
-from sqlalchemy import Column, Integer, String, Float, DateTime, func, ForeignKey
+from sqlalchemy import Column, Integer, String, Text, Float, DateTime, func, ForeignKey, Index, UniqueConstraint
+from sqlalchemy.orm import deferred
 from .database import Base 
 
 class Video(Base):
@@ -10,12 +11,22 @@ class Video(Base):
     duration = Column(Float)
     size = Column(Integer)
     upload_time = Column(DateTime(timezone=True), server_default=func.now())
+    sha256 = Column(String(64), index=True, nullable=True)  # content hash of uploaded files
+    status = Column(String, default="available")  # available, deleted
+    # Stream metadata read once at upload (or carried over from the source by tasks), so
+    # later work doesn't probe the file again; NULL when unknown
+    width = Column(Integer, nullable=True)
+    height = Column(Integer, nullable=True)
+    codec = Column(String, nullable=True)
+    frame_rate = Column(Float, nullable=True)
+    # JSON list of keyframe times in seconds; deferred so plain Video loads don't carry it
+    keyframes = deferred(Column(Text, nullable=True))
 
 
 class Job(Base):
     __tablename__ = "jobs"
 
-    id = Column(String, primary_key=True, index=True)  
+    id = Column(String, primary_key=True)
     original_video_id = Column(Integer, ForeignKey("videos.id"))
     updated_video_id = Column(Integer, ForeignKey("videos.id"), nullable=True)
     status = Column(String, default="pending")  # pending, completed, failed
@@ -24,11 +35,15 @@ class Job(Base):
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
     type = Column(String)
 
+    __table_args__ = (
+        Index("ix_jobs_orig_video", "original_video_id"),
+    )
+
 class Overlay(Base):
     __tablename__ = "overlays"
 
     id = Column(Integer, primary_key=True, index=True)
-    video_id = Column(Integer, ForeignKey("videos.id"))
+    video_id = Column(Integer, ForeignKey("videos.id"), index=True)
     overlay_type = Column(String)  # "text", "image", "video"
     content = Column(String)       # text content or image/video filename
     position_x = Column(Integer, default=10)
@@ -55,4 +70,9 @@ class VideoQuality(Base):
     height = Column(Integer)
     bitrate = Column(String)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+    # The unique index leads with video_id, so it also serves plain video_id lookups
+    __table_args__ = (
+        UniqueConstraint("video_id", "quality", name="uq_vq_vid_q"),
+    )
     
@@ -0,0 +1,47 @@
+import av
+
+
+def probe_video(path: str) -> dict:
+    """Duration plus the video stream's size, codec and frame rate, from the container header"""
+    with av.open(path) as container:
+        meta = {
+            "duration": container.duration / av.time_base if container.duration else 0.0,
+            "width": None, "height": None, "codec": None, "frame_rate": None,
+        }
+        stream = next(iter(container.streams.video), None)
+        if stream is not None:
+            meta.update(
+                width=stream.codec_context.width,
+                height=stream.codec_context.height,
+                codec=stream.codec_context.name,
+                frame_rate=float(stream.average_rate) if stream.average_rate else None,
+            )
+    return meta
+
+
+def probe_keyframes(path: str):
+    """Keyframe times in seconds, or None without a video stream.
+
+    Demuxes every video packet (no decoding), so it reads the whole file.
+    """
+    with av.open(path) as container:
+        stream = next(iter(container.streams.video), None)
+        if stream is None:
+            return None
+        # Offsets from the start of the stream, the same timeline -ss seeks on
+        start = stream.start_time or 0
+        return sorted(
+            round(float((packet.pts - start) * stream.time_base), 3)
+            for packet in container.demux(stream)
+            if packet.is_keyframe and packet.pts is not None
+        )
+
+
+def fast_probe(path: str):
+    """(duration, frame duration) in seconds, read in-process by libavformat instead of an ffprobe exec"""
+    with av.open(path) as container:
+        duration = container.duration / av.time_base if container.duration else 0.0
+        stream = next(iter(container.streams.video), None)
+        rate = stream.average_rate if stream else None
+    # 0.1s when the frame rate is unknown, as a tolerance that still catches a missed keyframe
+    return duration, float(1 / rate) if rate else 0.1
@@ -0,0 +1,55 @@
+from typing import List, Optional
+
+from pydantic import BaseModel, ConfigDict
+
+# Request models are taken with Depends(), so their fields stay query parameters;
+# endpoints get them grouped into one typed request object
+
+
+class TrimRequest(BaseModel):
+    video_id: int
+    start_time: float
+    end_time: float
+    reencode: bool = False
+
+
+class TextOverlayRequest(BaseModel):
+    video_id: int
+    text: str
+    x: int = 10
+    y: int = 10
+    font_size: int = 24
+    font_color: str = "white"
+    start_time: float = 0.0
+    end_time: float = 0.0
+    # Also convert to this quality, in the same encode
+    quality: Optional[str] = None
+
+
+class ImageOverlayRequest(BaseModel):
+    video_id: int
+    x: int = 10
+    y: int = 10
+    width: int = 100
+    height: int = 100
+    start_time: float = 0.0
+    end_time: float = 0.0
+    opacity: float = 1.0
+
+
+class VideoOverlayRequest(ImageOverlayRequest):
+    width: int = 320
+    height: int = 240
+
+
+class QualityRequest(BaseModel):
+    qualities: List[str] = ["720p", "480p"]
+
+
+class JobCreatedResponse(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+    job_id: str
+    status: str
+    message: str
+    type: Optional[str] = None
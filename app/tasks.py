@@ -1,15 +1,19 @@
+import functools
+import hashlib
+import json
+import re
+import shutil
 import subprocess
+import tempfile
 import os
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import undefer
 from . import models
-from .database import DATABASE_URL
+from .database import SyncSessionLocal as SessionLocal, sync_engine
+from .probe import fast_probe
+from .job_cache import cache_job_status
 import logging
-import ffmpeg
-
-# Create DB session
-engine = create_engine(DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -22,415 +26,639 @@ QUALITY_PRESETS = {
     "360p": {"width": 640, "height": 360, "bitrate": "1000k"},
 }   
 
-def get_db():
-    db = SessionLocal()
+FFMPEG_STDERR_TAIL = 4096  # bytes of ffmpeg stderr kept for error reports
+
+def _stderr_tail(err) -> bytes:
+    size = err.seek(0, os.SEEK_END)
+    err.seek(max(0, size - FFMPEG_STDERR_TAIL))
+    return err.read()
+
+@functools.lru_cache(maxsize=None)
+def _ffmpeg_bin(name: str) -> str:
+    """Absolute path of the ffmpeg binary, so each exec skips the $PATH search"""
+    return shutil.which(name) or name
+
+def _run_ffmpeg(cmd, progress=False):
+    """Run ffmpeg with stderr spooled to a temp file; only its tail is read.
+
+    With progress=True, returns the output duration in seconds from ffmpeg's
+    final -progress report (None if it didn't report one).
+    """
+    # Only errors and the -progress report reach stderr, so there is little to spool.
+    # -nostdin: ffmpeg otherwise sets up stdin for interactive keys on every run
+    extra = ['-nostdin', '-hide_banner', '-nostats', '-loglevel', 'error']
+    if progress:
+        extra += ['-progress', 'pipe:2']
+    cmd = [_ffmpeg_bin(cmd[0]), *extra, *cmd[1:]]
+    # The log stays on disk (or in page cache) instead of in worker RSS, and the
+    # happy path reads at most its last few KB
+    with tempfile.TemporaryFile() as err:
+        rc = subprocess.run(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=err).returncode
+        if rc != 0:
+            message = _stderr_tail(err).decode("utf-8", errors="replace")
+            raise Exception(f"ffmpeg exited with {rc}: {message}")
+        if progress:
+            out_times = re.findall(rb'out_time_us=(\d+)', _stderr_tail(err))
+            return int(out_times[-1]) / 1_000_000 if out_times else None
+
+def _fast_meta(output_path: str, known_duration=None):
+    """(duration, size) of a file we just wrote; the file is only probed if the duration is unknown"""
+    size = os.path.getsize(output_path)
+    if known_duration is None:
+        known_duration, _ = fast_probe(output_path)
+    return known_duration, size
+
+def _insert_video(db, job, output_path: str, duration, size, **meta) -> int:
+    """Add the job's output video with one INSERT ... RETURNING id, skipping the ORM flush"""
+    return db.execute(
+        insert(models.Video).values(
+            filename=os.path.basename(output_path),
+            original_video_id=job.original_video_id,
+            duration=duration,
+            size=size,
+            **meta
+        ).returning(models.Video.id)
+    ).scalar_one()
+
+def _derived_meta(source, **changes) -> dict:
+    """Stream metadata of an output made from source: what the operation keeps, plus changes.
+    Anything a task re-encodes loses the source's keyframes"""
+    meta = {}
+    if source:
+        meta = {"width": source.width, "height": source.height, "codec": source.codec, "frame_rate": source.frame_rate}
+    meta.update(changes)
+    return meta
+
+def _get_job(db, job_id: str):
+    job = db.get(models.Job, job_id)
+    if not job:
+        raise Exception(f"Job {job_id} not found")
+    return job
+
+def _complete_job(db, job, result_filename: str, updated_video_id: int):
+    """Commit db's transaction with job (loaded in an earlier session) completed, then cache its status"""
+    job = db.merge(job, load=False)  # reattach without another SELECT
+    job.status = "completed"
+    job.result_filename = result_filename
+    job.updated_video_id = updated_video_id
+    db.commit()
+    cache_job_status(job)
+    return job
+
+def _mark_processing(task, job_id: str):
+    # Progress goes to the result backend, not a DB commit; /status merges it in
+    task.update_state(state="PROCESSING", meta={"job_id": job_id})
+
+def _fail_job(job_id: str):
+    with SessionLocal() as db:
+        job = db.get(models.Job, job_id)
+        if job:
+            job.status = "failed"
+            job.result_filename = None
+            job.updated_video_id = None
+            db.commit()
+            cache_job_status(job)
+
+# Probed on first use, once per worker process, so importing tasks (as the API does) stays cheap
+@functools.lru_cache(maxsize=None)
+def has_nvenc() -> bool:
+    """True when ffmpeg can actually open an NVENC session on this host"""
+    # Listing encoders isn't enough: distro ffmpeg builds ship h264_nvenc even
+    # without a GPU, so try a tiny encode instead
     try:
-        yield db
-    finally:
-        db.close()
+        return subprocess.run(
+            [_ffmpeg_bin('ffmpeg'), '-nostdin', '-hide_banner', '-loglevel', 'error',
+             '-f', 'lavfi', '-i', 'nullsrc=s=256x256:d=0.1',
+             '-c:v', 'h264_nvenc', '-f', 'null', '-'],
+            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=30
+        ).returncode == 0
+    except (OSError, subprocess.SubprocessError):
+        return False
+
+# For graphs that stay on the GPU end to end. One named device serves the decoder,
+# the CUDA filters and the encoder, so ffmpeg creates a single CUDA context instead of one each.
+# Overlays run CPU filters (drawtext, overlay) and keep decoding on the CPU
+CUDA_DECODE_ARGS = [
+    '-init_hw_device', 'cuda=cu:0', '-filter_hw_device', 'cu',
+    '-hwaccel', 'cuda', '-hwaccel_device', 'cu', '-hwaccel_output_format', 'cuda',
+]
 
 # Import celery_app AFTER db setup
-from .celery_app import celery_app
-
-@celery_app.task(bind=True, name="app.tasks.trim_video_task")
-def trim_video_task(self, job_id: str, input_path: str, output_path: str, start_time: float, duration: float):
-    
-    db = next(get_db())
-    
+from .celery_app import celery_app, CELERY_CONCURRENCY, REENCODE_QUEUE
+from celery.signals import worker_init, worker_process_init
+
+@worker_init.connect
+def _start_cuda_mps(**_):
+    # With the MPS control daemon up, each ffmpeg attaches to its shared server context
+    # instead of initialising the GPU from scratch. Opt-in: needs the host's MPS pipe directory
+    if os.getenv('CUDA_MPS', 'false').lower() != 'true':
+        return
+    try:
+        # Exits non-zero if a daemon is already running, which is fine
+        subprocess.run(['nvidia-cuda-mps-control', '-d'], stdin=subprocess.DEVNULL, timeout=10)
+    except (OSError, subprocess.SubprocessError) as e:
+        logger.warning(f"Could not start CUDA MPS: {e}")
+
+@worker_process_init.connect
+def _init_engine(**_):
+    # Pool processes are forked from the main worker: drop the inherited
+    # connections (without closing the parent's sockets) so each child opens its own
+    sync_engine.dispose(close=False)
+
+# Split the cores between concurrent tasks instead of letting every ffmpeg use them all.
+# libx264 gains little past 4 threads, so wider boxes should raise concurrency instead
+FFMPEG_MAX_THREADS = 4
+FFMPEG_THREADS = max(1, min(FFMPEG_MAX_THREADS, (os.cpu_count() or 1) // CELERY_CONCURRENCY))
+
+def _video_encoder_args(bitrate=None, threads=FFMPEG_THREADS, x264_opts=()):
+    """H.264 encoder flags: NVENC when this host has it, libx264 otherwise"""
+    if has_nvenc():
+        # No -tune zerolatency: it drops lookahead and B-frames, which only pays off for live streams
+        args = ['-c:v', 'h264_nvenc', '-preset', 'p4', '-rc', 'vbr']
+        return args + (['-b:v', bitrate] if bitrate else ['-cq', '23'])
+    args = ['-threads', str(threads), '-c:v', 'libx264', '-preset', 'veryfast', *x264_opts]
+    return args + (['-b:v', bitrate] if bitrate else ['-crf', '23'])
+
+@celery_app.task(bind=True, name="app.tasks.trim_video_task", ignore_result=True)
+def trim_video_task(self, job_id: str, input_path: str, output_path: str, start_time: float, duration: float,
+                    reencode: bool = False):
+    """Cut [start_time, start_time + duration) out of input_path.
+
+    By default the streams are copied, so the cut starts at the keyframe at or before
+    start_time. If that drifts the output by more than a frame, or reencode=True,
+    the segment is re-encoded for a frame-accurate cut.
+    """
+    requested_reencode = reencode
     try:
-        job = db.query(models.Job).filter(models.Job.id == job_id).first()
-        if not job:
-            raise Exception(f"Job {job_id} not found")
+        # Read what the task needs and give the connection back before ffmpeg runs
+        with SessionLocal() as db:
+            job = _get_job(db, job_id)
+            source = db.get(models.Video, job.original_video_id, options=[undefer(models.Video.keyframes)])
 
-        job.status = "processing"
-        db.commit()
+        _mark_processing(self, job_id)
 
-        # FFmpeg trim
-        cmd = [
-            'ffmpeg',
-            '-i', input_path,
-            '-ss', str(start_time),
-            '-t', str(duration),
-            '-c:v', 'libx264',
-            '-c:a', 'aac',
-            '-strict', 'experimental',
-            output_path
-        ]
-        subprocess.run(cmd, check=True, capture_output=True, text=True)
-
-        if not os.path.exists(output_path):
-            raise Exception("Output file not created")
+        # moov atom up front so players can start before the whole file downloads
+        faststart = ['-movflags', '+faststart'] if output_path.lower().endswith(('.mp4', '.mov', '.m4v')) else []
 
-        # Get metadata
-        probe = ffmpeg.probe(output_path)
-        format_info = probe.get('format', {})
-        new_duration = float(format_info.get('duration', 0.0))
-        new_size = int(format_info.get('size', 0))
+        # Length the cut should come out at: the request, clamped to the end of the source
+        expected = duration
+        if source and source.duration:
+            expected = min(duration, source.duration - start_time)
 
-        # Save new video
-        new_video = models.Video(
-            filename=os.path.basename(output_path),
-            original_video_id=f"{job.original_video_id}",
-            duration=new_duration,
-            size=new_size
-        )
-        db.add(new_video)
-        db.commit()
+        # With the source's keyframes on record, decide up front whether a copy would start on time
+        keyframes = json.loads(source.keyframes) if source and source.keyframes else None
+        copy_start = None
+        if not reencode and keyframes is not None and source.frame_rate:
+            # A copy starts at the last keyframe at or before start_time
+            copy_start = max((k for k in keyframes if k <= start_time), default=0.0)
+            reencode = start_time - copy_start > 1 / source.frame_rate
 
-        # Update job
-        job.status = "completed"
-        job.result_filename = os.path.basename(output_path)
-        job.updated_video_id = new_video.id
-        db.commit()
+        # FFmpeg trim
+        if not reencode:
+            # Fast path, stream copy: input seek snaps to the nearest keyframe, no decode/encode
+            _run_ffmpeg([
+                'ffmpeg', '-y',
+                '-ss', str(start_time),
+                '-i', input_path,
+                '-t', str(duration),
+                '-c', 'copy',
+                '-avoid_negative_ts', 'make_zero',
+                *faststart,
+                output_path
+            ])
+
+            if copy_start is not None:
+                # Starts within a frame of start_time, so it's as long as asked for
+                actual = expected
+            else:
+                # A cut that didn't land on a keyframe comes out longer than requested;
+                # more than one frame off means we need the accurate path after all
+                actual, frame_duration = fast_probe(output_path)
+                reencode = abs(actual - expected) > frame_duration
+
+        if reencode and not requested_reencode:
+            # Decided here, on the eventlet trim worker: one green thread per encode would
+            # oversubscribe the CPU, so hand the encode to the prefork encode workers
+            trim_video_task.apply_async(
+                args=[job_id, input_path, output_path, start_time, duration, True],
+                task_id=job_id,
+                queue=REENCODE_QUEUE,
+                ignore_result=True
+            )
+            return {"status": "requeued", "job_id": job_id}
+
+        if reencode:
+            # Frame-accurate cut. -ss before -i is still exact when transcoding,
+            # and seeks via the index instead of decoding up to the start point
+            # With NVENC, decode on the GPU too; frames never leave device memory
+            decode_args = CUDA_DECODE_ARGS if has_nvenc() else []
+            encode_args = _video_encoder_args(x264_opts=['-tune', 'fastdecode'])
+            _run_ffmpeg([
+                'ffmpeg', '-y',
+                *decode_args,
+                '-ss', str(start_time),
+                '-i', input_path,
+                '-t', str(duration),
+                *encode_args,
+                '-c:a', 'aac',
+                '-strict', 'experimental',
+                *faststart,
+                output_path
+            ])
+
+        # Get metadata: the copy was already probed above, and a re-encode is exact
+        new_duration, new_size = _fast_meta(output_path, expected if reencode else actual)
+        if reencode:
+            meta = _derived_meta(source, codec="h264")
+        else:
+            # A copy keeps the source's keyframes that fall inside the cut, shifted to its start
+            meta = _derived_meta(source)
+            if copy_start is not None:
+                meta["keyframes"] = json.dumps([
+                    round(k - copy_start, 3) for k in keyframes if copy_start <= k < copy_start + new_duration
+                ])
+
+        # Save new video and update job, in a session opened only now
+        with SessionLocal() as db:
+            new_video_id = _insert_video(db, job, output_path, new_duration, new_size, **meta)
+            job = _complete_job(db, job, os.path.basename(output_path), new_video_id)
 
         return {
             "status": "completed",
             "job_id": job_id,
-            "video_id": new_video.id,
+            "video_id": new_video_id,
             "filename": job.result_filename
         }
 
     except Exception as e:
-        db.rollback()
-        job = db.query(models.Job).filter(models.Job.id == job_id).first()
-        if job:
-            job.status = "failed"
-            job.result_filename = None
-            job.updated_video_id = None
-            db.commit()
+        _fail_job(job_id)
         raise Exception(f"Trim failed: {str(e)}")
-    finally:
-        db.close()
 
-@celery_app.task(bind=True, name="app.tasks.add_text_overlay_task")
+def _filter_arg(value) -> str:
+    """Escape a filter option value for both levels ffmpeg parses it at: the
+    option string (key=value:key=value) and then the filtergraph around it"""
+    value = re.sub(r"([\\':])", r"\\\1", str(value))
+    return re.sub(r"([\\'\[\],;])", r"\\\1", value)
+
+def _overlay_textfile(overlay) -> str:
+    """The overlay's text as a UTF-8 file for drawtext's textfile=; written once per distinct text"""
+    data = overlay.content.encode('utf-8')
+    # Named by content, not overlay id: ids are reused when the DB is recreated, but a
+    # hash can't point at another overlay's text. Retries and repeated texts share a file
+    path = os.path.join(tempfile.gettempdir(), f"ov_{hashlib.sha256(data).hexdigest()[:32]}.txt")
+    if not os.path.exists(path):
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.txt')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)  # concurrent writers race harmlessly
+    return path
+
+def _drawtext_filter(overlay) -> str:
+    # The text goes through a file, not text=, so no character in it can break the filter
+    # string; expansion=none stops drawtext reading %{...} in it as expressions
+    fontsize = overlay.font_size or 24
+    fontcolor = overlay.font_color or "white"
+
+    # Position
+    x = overlay.position_x
+    y = overlay.position_y
+
+    args = [
+        f"textfile={_filter_arg(_overlay_textfile(overlay))}",
+        "expansion=none",
+        f"x={x}",
+        f"y={y}",
+        f"fontsize={fontsize}",
+        f"fontcolor={_filter_arg(fontcolor)}",
+    ]
+    if overlay.end_time > 0:
+        args.append(f"enable={_filter_arg(f'between(t,{overlay.start_time},{overlay.end_time})')}")
+
+    return "drawtext=" + ":".join(args)
+
+@celery_app.task(bind=True, name="app.tasks.add_text_overlay_task", ignore_result=True)
 def add_text_overlay_task(self, job_id: str, input_path: str, output_path: str, overlay_id: int):
-    db = next(get_db())
-
     try:
-        # Get job and overlay
-        job = db.query(models.Job).filter(models.Job.id == job_id).first()
-        if not job:
-            raise Exception(f"Job {job_id} not found")
-        
-        overlay = db.query(models.Overlay).filter(models.Overlay.id == overlay_id).first()
+        # Get job, overlay and source, then give the connection back before ffmpeg runs
+        with SessionLocal() as db:
+            job = _get_job(db, job_id)
+            overlay = db.get(models.Overlay, overlay_id)
+            source = db.get(models.Video, job.original_video_id)
         if not overlay:
             raise Exception(f"Overlay {overlay_id} not found")
 
-        job.status = "processing"
-        db.commit()
-
-        text = overlay.content.replace("'", r"'\''")  # Escape single quotes
-        fontsize = overlay.font_size or 24
-        fontcolor = overlay.font_color or "white"
-        
-        # Position
-        x = overlay.position_x
-        y = overlay.position_y
-
-        enable_param = ""
-        if overlay.end_time > 0:
-            enable_param = f":enable='between(t,{overlay.start_time},{overlay.end_time})'"
-
-        filter_string = f"drawtext=text='{text}':x={x}:y={y}:fontsize={fontsize}:fontcolor={fontcolor}{enable_param}"
+        _mark_processing(self, job_id)
 
         cmd = [
-            'ffmpeg',
+            'ffmpeg', '-y',
             '-i', input_path,
-            '-vf', filter_string,
+            '-vf', _drawtext_filter(overlay),
+            *_video_encoder_args(),
             '-c:a', 'copy',
             output_path
         ]
-        subprocess.run(cmd, check=True, capture_output=True, text=True)
-
-        if not os.path.exists(output_path):
-            raise Exception("Output file not created")
+        out_time = _run_ffmpeg(cmd, progress=True)
 
-        # Get metadata
-        
-        probe = ffmpeg.probe(output_path)
-        format_info = probe.get('format', {})
-        new_duration = float(format_info.get('duration', 0.0))
-        new_size = int(format_info.get('size', 0))
+        # Get metadata from ffmpeg's own progress report instead of an ffprobe
+        new_duration, new_size = _fast_meta(output_path, out_time)
 
-        new_video = models.Video(
-            filename=os.path.basename(output_path),
-            original_video_id=job.original_video_id,
-            duration=new_duration,
-            size=new_size
-        )
-        db.add(new_video)
-        db.commit()
-
-        job.status = "completed"
-        job.result_filename = os.path.basename(output_path)
-        job.updated_video_id = new_video.id
-        db.commit()
+        with SessionLocal() as db:
+            new_video_id = _insert_video(
+                db, job, output_path, new_duration, new_size, **_derived_meta(source, codec="h264")
+            )
+            job = _complete_job(db, job, os.path.basename(output_path), new_video_id)
 
         return {
             "status": "completed",
             "job_id": job_id,
-            "video_id": new_video.id,
+            "video_id": new_video_id,
             "filename": job.result_filename
         }
 
     except Exception as e:
-        job = db.query(models.Job).filter(models.Job.id == job_id).first()
-        if job:
-            job.status = "failed"
-            job.result_filename = None
-            db.commit()
+        _fail_job(job_id)
         raise Exception(f"Text overlay failed: {str(e)}")
-    finally:
-        db.close()
 
 
-@celery_app.task(bind=True, name="app.tasks.add_image_overlay_task")
+# Filter graphs for the image and video overlays, keyed by whether the overlay is timed
+# Opacity isn't applied yet; it would go after the scale: ,format=rgba,colorchannelmixer=aa={opacity}
+_OVERLAY_TMPL = {
+    "timed": "[1:v]scale={w}:{h}[overlay_scaled];[0:v][overlay_scaled]overlay=x={x}:y={y}:enable='between(t,{a},{b})'",
+    "static": "[1:v]scale={w}:{h}[overlay_scaled];[0:v][overlay_scaled]overlay=x={x}:y={y}",
+}
+
+@celery_app.task(bind=True, name="app.tasks.add_image_overlay_task", ignore_result=True)
 def add_image_overlay_task(self, job_id: str, input_path: str, output_path: str, img_path: str,
                             x: int, y: int, width: int, height: int,
                             start_time: float, end_time: float, opacity: float):
     """Add image overlay to video"""
-    db = next(get_db())
-    
     try:
-        job = db.query(models.Job).filter(models.Job.id == job_id).first()
-        if not job:
-            raise Exception(f"Job {job_id} not found")
-
-        job.status = "processing"
-        db.commit()
-
-        # Build FFmpeg filter
-        # Scale image
-        scale_filter = f"[1:v]scale={width}:{height}[overlay_scaled]"
-        
-        # Position and timing
-        overlay_filter = f"[0:v][overlay_scaled]overlay=x={x}:y={y}"
-        
-        # Add opacity
-        # if opacity < 1.0:
-        #     overlay_filter += f",format=rgba,colorchannelmixer=aa={opacity}"
-        
-        # Add timing
-        if end_time > 0:
-            overlay_filter += f":enable='between(t,{start_time},{end_time})'"
-        
-        filter_complex = f"{scale_filter};{overlay_filter}"
+        # Read the job and source; the session closes before ffmpeg runs
+        with SessionLocal() as db:
+            job = _get_job(db, job_id)
+            source = db.get(models.Video, job.original_video_id)
+
+        _mark_processing(self, job_id)
+
+        # Build FFmpeg filter: scale the overlay input, then position it (and time it)
+        filter_complex = _OVERLAY_TMPL["timed" if end_time > 0 else "static"].format(
+            w=width, h=height, x=x, y=y, a=start_time, b=end_time
+        )
 
         # Run FFmpeg
         cmd = [
-            'ffmpeg',
+            'ffmpeg', '-y',
             '-i', input_path,
             '-i', img_path,
             '-filter_complex', filter_complex,
+            *_video_encoder_args(),
             '-c:a', 'copy',
             output_path
         ]
         logger.info(f"filter command {filter_complex}")
-        subprocess.run(cmd, check=True, capture_output=True, text=True)
-
-        if not os.path.exists(output_path):
-            raise Exception("Output file not created")
-
+        out_time = _run_ffmpeg(cmd, progress=True)
 
-        probe = ffmpeg.probe(output_path)
-        format_info = probe.get('format', {})
-        new_duration = float(format_info.get('duration', 0.0))
-        new_size = int(format_info.get('size', 0))
-
-        # Save new video
-        new_video = models.Video(
-            filename=os.path.basename(output_path),
-            original_video_id=job.original_video_id,
-            duration=new_duration,
-            size=new_size
-        )
-        db.add(new_video)
-        db.commit()
+        new_duration, new_size = _fast_meta(output_path, out_time)
 
-        # Update job
-        job.status = "completed"
-        job.result_filename = os.path.basename(output_path)
-        job.updated_video_id = new_video.id
-        db.commit()
+        # Save new video and update job, in a session opened only now
+        with SessionLocal() as db:
+            new_video_id = _insert_video(
+                db, job, output_path, new_duration, new_size, **_derived_meta(source, codec="h264")
+            )
+            job = _complete_job(db, job, os.path.basename(output_path), new_video_id)
 
         return {
             "status": "completed",
             "job_id": job_id,
-            "video_id": new_video.id,
+            "video_id": new_video_id,
             "filename": job.result_filename
         }
 
     except Exception as e:
-        job = db.query(models.Job).filter(models.Job.id == job_id).first()
-        if job:
-            job.status = "failed"
-            job.result_filename = None
-            db.commit()
+        _fail_job(job_id)
         raise Exception(f"Image overlay failed: {str(e)}")
-    finally:
-        db.close()
 
-@celery_app.task(bind=True, name="app.tasks.add_video_overlay_task")
+@celery_app.task(bind=True, name="app.tasks.add_video_overlay_task", ignore_result=True)
 def add_video_overlay_task(self, job_id: str, input_path: str, output_path: str, overlay_path: str,
                           x: int, y: int, width: int, height: int,
                           start_time: float, end_time: float, opacity: float):
     """Add video overlay to video"""
-    db = next(get_db())
-    
     try:
-        job = db.query(models.Job).filter(models.Job.id == job_id).first()
-        if not job:
-            raise Exception(f"Job {job_id} not found")
-
-        job.status = "processing"
-        db.commit()
-
-        # Build FFmpeg filter
-        # Scale overlay video
-        scale_filter = f"[1:v]scale={width}:{height}[overlay_scaled]"
-        
-        # Position and timing
-        overlay_filter = f"[0:v][overlay_scaled]overlay=x={x}:y={y}"
-        
-        # Add opacity
-        # if opacity < 1.0:
-        #     overlay_filter += f",format=rgba,colorchannelmixer=aa={opacity}"
-        
-        # Add timing
-        if end_time > 0:
-            overlay_filter += f":enable='between(t,{start_time},{end_time})'"
-        
-        filter_complex = f"{scale_filter};{overlay_filter}"
+        # Read the job and source; the session closes before ffmpeg runs
+        with SessionLocal() as db:
+            job = _get_job(db, job_id)
+            source = db.get(models.Video, job.original_video_id)
+
+        _mark_processing(self, job_id)
+
+        # Build FFmpeg filter: scale the overlay input, then position it (and time it)
+        filter_complex = _OVERLAY_TMPL["timed" if end_time > 0 else "static"].format(
+            w=width, h=height, x=x, y=y, a=start_time, b=end_time
+        )
         logger.info(f"filter command {filter_complex}")
         # Run FFmpeg
         cmd = [
-            'ffmpeg',
+            'ffmpeg', '-y',
             '-i', input_path,
             '-i', overlay_path,
             '-filter_complex', filter_complex,
+            *_video_encoder_args(),
             '-c:a', 'copy',
             output_path
         ]
-        subprocess.run(cmd, check=True, capture_output=True, text=True)
+        out_time = _run_ffmpeg(cmd, progress=True)
         logger.info(f"FFmpeg filter_complex: {filter_complex}")
 
-        if not os.path.exists(output_path):
-            raise Exception("Output file not created")
-
-        probe = ffmpeg.probe(output_path)
-        format_info = probe.get('format', {})
-        new_duration = float(format_info.get('duration', 0.0))
-        new_size = int(format_info.get('size', 0))
+        new_duration, new_size = _fast_meta(output_path, out_time)
 
-        # Save new video
-        new_video = models.Video(
-            filename=os.path.basename(output_path),
-            original_video_id=job.original_video_id,
-            duration=new_duration,
-            size=new_size
-        )
-        db.add(new_video)
-        db.commit()
-
-        # Update job
-        job.status = "completed"
-        job.result_filename = os.path.basename(output_path)
-        job.updated_video_id = new_video.id
-        db.commit()
+        # Save new video and update job, in a session opened only now
+        with SessionLocal() as db:
+            new_video_id = _insert_video(
+                db, job, output_path, new_duration, new_size, **_derived_meta(source, codec="h264")
+            )
+            job = _complete_job(db, job, os.path.basename(output_path), new_video_id)
 
         return {
             "status": "completed",
             "job_id": job_id,
-            "video_id": new_video.id,
+            "video_id": new_video_id,
             "filename": job.result_filename
         }
 
     except Exception as e:
-        job = db.query(models.Job).filter(models.Job.id == job_id).first()
-        if job:
-            job.status = "failed"
-            job.result_filename = None
-            db.commit()
+        _fail_job(job_id)
         raise Exception(f"Video overlay failed: {str(e)}")
-    finally:
-        db.close()
 
 
-@celery_app.task(bind=True, name="app.tasks.convert_quality_task")
-def convert_quality_task(self, job_id: str, input_path: str, output_path: str, quality: str):
-    db = next(get_db())
-    
+@celery_app.task(bind=True, name="app.tasks.convert_quality_task", ignore_result=True)
+def convert_quality_task(self, job_id: str, input_path: str, outputs: dict):
+    """Encode every requested quality from one decode of the source.
+
+    outputs maps quality name -> output path.
+    """
     try:
-        # Get job
-        job = db.query(models.Job).filter(models.Job.id == job_id).first()
-        if not job:
-            raise Exception(f"Job {job_id} not found")
+        # Get job; the session closes before ffmpeg runs
+        with SessionLocal() as db:
+            job = _get_job(db, job_id)
+
+        _mark_processing(self, job_id)
+
+        # Get quality presets
+        unknown = [q for q in outputs if q not in QUALITY_PRESETS]
+        if unknown:
+            raise Exception(f"Unknown quality: {unknown}")
+
+        # Decode once and scale down as a cascade, largest rendition first: each
+        # rung is scaled from the one above it instead of from the full-size source
+        qualities = sorted(outputs, key=lambda q: QUALITY_PRESETS[q]["height"], reverse=True)
+        # With NVENC the whole graph stays on the GPU: NVDEC decode, CUDA scaling
+        use_nvenc = has_nvenc()
+        scaler = 'scale_cuda' if use_nvenc else 'scale'
+        rungs = []
+        for i, q in enumerate(qualities):
+            source = '[0:v]' if i == 0 else f'[c{i - 1}]'
+            rung = f'{source}{scaler}={QUALITY_PRESETS[q]["width"]}:{QUALITY_PRESETS[q]["height"]}'
+            # Every rung but the last also feeds the next one down
+            rung += f',split=2[o{i}][c{i}]' if i < len(qualities) - 1 else f'[o{i}]'
+            rungs.append(rung)
+        # The encoders share this task's thread budget
+        threads = max(1, FFMPEG_THREADS // len(qualities))
 
-        job.status = "processing"
-        db.commit()
+        # FFmpeg command for quality conversion
+        cmd = ['ffmpeg', '-y']
+        if use_nvenc:
+            cmd += CUDA_DECODE_ARGS
+        cmd += [
+            '-i', input_path,
+            '-filter_complex', ';'.join(rungs),
+        ]
+        for i, quality in enumerate(qualities):
+            cmd += [
+                '-map', f'[o{i}]',
+                '-map', '0:a?',
+                *_video_encoder_args(
+                    QUALITY_PRESETS[quality]["bitrate"],
+                    threads=threads,
+                    # Frame threading: better throughput than sliced threads for file output
+                    x264_opts=['-x264-params', 'sliced-threads=0']
+                ),
+                '-c:a', 'aac',
+                '-b:a', '192k',
+                '-strict', 'experimental',
+                outputs[quality]
+            ]
+    
+        # Execute
+        _run_ffmpeg(cmd)
+
+        # Raises FileNotFoundError if ffmpeg didn't write an output
+        file_sizes = {quality: os.path.getsize(output_path) for quality, output_path in outputs.items()}
+
+        stored = []
+        with SessionLocal() as db:
+            for quality, output_path in outputs.items():
+                # Save quality record
+                preset = QUALITY_PRESETS[quality]
+                try:
+                    # A savepoint per row: if an overlapping job recorded this quality
+                    # first, only this row is dropped, not the job's other qualities
+                    with db.begin_nested():
+                        db.add(models.VideoQuality(
+                            video_id=job.original_video_id,
+                            quality=quality,
+                            file_path=os.path.basename(output_path),
+                            file_size=file_sizes[quality],
+                            width=preset['width'],
+                            height=preset['height'],
+                            bitrate=preset['bitrate']
+                        ))
+                except IntegrityError:
+                    logger.info(f"{quality} of video {job.original_video_id} already recorded, discarding {output_path}")
+                    os.remove(output_path)
+                    continue
+                stored.append(os.path.basename(output_path))
+
+            # Update job; one job now covers several files
+            job = _complete_job(db, job, ",".join(stored) or None, job.original_video_id)
 
-        # Get quality preset
-        if quality not in QUALITY_PRESETS:
-            raise Exception(f"Unknown quality: {quality}")
-        
-        preset = QUALITY_PRESETS[quality]
+        return {
+            "status": "completed",
+            "job_id": job_id,
+            "qualities": qualities,
+            "file_sizes": file_sizes
+        }
+
+    except Exception as e:
+        _fail_job(job_id)
+        raise Exception(f"Quality conversion failed: {str(e)}")
+
+
+@celery_app.task(bind=True, name="app.tasks.composite_task", ignore_result=True)
+def composite_task(self, job_id: str, input_path: str, output_path: str, overlay_id: int = None, quality: str = None):
+    """Text overlay and/or quality conversion as one filter chain, so the source is decoded and encoded once"""
+    try:
+        # Read the job and overlay, then give the connection back before ffmpeg runs
+        with SessionLocal() as db:
+            job = _get_job(db, job_id)
+            overlay = db.get(models.Overlay, overlay_id) if overlay_id is not None else None
+            source = db.get(models.Video, job.original_video_id)
+
+        filters = []
+        if overlay_id is not None:
+            if not overlay:
+                raise Exception(f"Overlay {overlay_id} not found")
+            filters.append(_drawtext_filter(overlay))
+        preset = None
+        if quality is not None:
+            preset = QUALITY_PRESETS.get(quality)
+            if not preset:
+                raise Exception(f"Unknown quality: {quality}")
+            # Text is drawn first, at source resolution, so it scales with the frame
+            filters.append(f'scale={preset["width"]}:{preset["height"]}')
+        if not filters:
+            raise Exception("Nothing to composite")
+
+        _mark_processing(self, job_id)
 
-        # FFmpeg command for quality conversion
         cmd = [
-            'ffmpeg',
+            'ffmpeg', '-y',
             '-i', input_path,
-            '-vf', f'scale={preset["width"]}:{preset["height"]}',
-            '-c:v', 'libx264',
-            '-b:v', preset["bitrate"],
-            '-c:a', 'aac',
-            '-b:a', '192k',
-            '-strict', 'experimental',
+            '-vf', ",".join(filters),
+            *_video_encoder_args(preset["bitrate"] if preset else None),
+            '-c:a', 'copy',
             output_path
         ]
-        
-        # Execute
-        subprocess.run(cmd, check=True, capture_output=True, text=True)
-
-        # Verify output
-        if not os.path.exists(output_path):
-            raise Exception("Output file not created")
-
-        probe = ffmpeg.probe(output_path)
-        format_info = probe.get('format', {})
-        new_size = int(format_info.get('size', 0))
-
-        # Save quality record
-        quality_record = models.VideoQuality(
-            video_id=job.original_video_id,
-            quality=quality,
-            file_path=os.path.basename(output_path),
-            file_size=new_size,
-            width=preset['width'],
-            height=preset['height'],
-            bitrate=preset['bitrate']
-        )
-        db.add(quality_record)
-        db.commit()
+        out_time = _run_ffmpeg(cmd, progress=True)
+
+        new_duration, new_size = _fast_meta(output_path, out_time)
+
+        meta = _derived_meta(source, codec="h264")
+        if preset:
+            meta.update(width=preset['width'], height=preset['height'])
+
+        with SessionLocal() as db:
+            new_video_id = _insert_video(db, job, output_path, new_duration, new_size, **meta)
+
+            if preset:
+                db.add(models.VideoQuality(
+                    video_id=new_video_id,
+                    quality=quality,
+                    file_path=os.path.basename(output_path),
+                    file_size=new_size,
+                    width=preset['width'],
+                    height=preset['height'],
+                    bitrate=preset['bitrate']
+                ))
 
-        # Update job
-        job.status = "completed"
-        job.result_filename = os.path.basename(output_path)
-        job.updated_video_id = job.original_video_id
-        db.commit()
+            job = _complete_job(db, job, os.path.basename(output_path), new_video_id)
 
         return {
             "status": "completed",
             "job_id": job_id,
-            "quality": quality,
-            "file_size": new_size
+            "video_id": new_video_id,
+            "filename": job.result_filename
         }
 
     except Exception as e:
-        job = db.query(models.Job).filter(models.Job.id == job_id).first()
-        if job:
-            job.status = "failed"
-            job.result_filename = None
-            db.commit()
-        raise Exception(f"Quality conversion failed: {str(e)}")
-    finally:
-        db.close()
\ No newline at end of file
+        _fail_job(job_id)
+        raise Exception(f"Composite failed: {str(e)}")